@@ -3,6 +3,8 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, List
+import asyncio
+import re
 import sqlite3
 import hashlib
 import jwt
@@ -29,6 +31,16 @@ ALGORITHM = "HS256"
 # Database setup
 DATABASE_PATH = "sehat_sathi.db"
 
+# Trend rollups
+ROLLUP_INTERVAL_SECONDS = int(os.environ.get("ROLLUP_INTERVAL_SECONDS", 3600))
+EXPIRY_WINDOW_DAYS = 30
+MAX_TREND_WINDOW_DAYS = 1825
+TREND_BUCKETS = {
+    "day": "snapshot_date",
+    "week": "date(snapshot_date, '-6 days', 'weekday 1')",
+    "month": "strftime('%Y-%m-01', snapshot_date)",
+}
+
 @contextmanager
 def get_db():
     conn = sqlite3.connect(DATABASE_PATH, timeout=30.0)
@@ -150,8 +162,76 @@ def init_db():
             )
         ''')
         
+        # Daily stock rollups for trend analytics. One row per day per key:
+        # scope 'medicine' (region = ''), 'region' (medicine_name = '') or
+        # 'region_medicine'. The key leads the primary key so a range query
+        # for one series is a single contiguous index scan.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stock_daily_rollups (
+                scope TEXT NOT NULL,
+                region TEXT NOT NULL DEFAULT '',
+                medicine_name TEXT NOT NULL DEFAULT '',
+                snapshot_date DATE NOT NULL,
+                total_quantity INTEGER NOT NULL,
+                pharmacy_count INTEGER NOT NULL,
+                batch_count INTEGER NOT NULL,
+                expiring_quantity INTEGER NOT NULL,
+                PRIMARY KEY (scope, region, medicine_name, snapshot_date)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_stock_daily_rollups_date
+            ON stock_daily_rollups (snapshot_date)
+        ''')
+        
         conn.commit()
 
+def region_from_address(address: Optional[str]) -> str:
+    # Addresses end with "<City>, <State> <PIN>", so the state is the last
+    # comma-separated part with the PIN code stripped.
+    if not address:
+        return "Unknown"
+    region = re.sub(r"\s*\d{6}$", "", address.rsplit(",", 1)[-1].strip())
+    return region or "Unknown"
+
+def build_daily_rollups(snapshot_date: Optional[datetime.date] = None):
+    # Only the given day's rows are rewritten, so earlier days are kept as
+    # history and each run only scans the current stock table.
+    snapshot_date = (snapshot_date or datetime.date.today()).isoformat()
+    dimensions = [
+        ("medicine", "''", "ps.medicine_name"),
+        ("region", "region_from_address(u.address)", "''"),
+        ("region_medicine", "region_from_address(u.address)", "ps.medicine_name"),
+    ]
+    
+    with get_db() as conn:
+        conn.create_function("region_from_address", 1, region_from_address, deterministic=True)
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM stock_daily_rollups WHERE snapshot_date = ?", (snapshot_date,))
+        
+        for scope, region_expr, medicine_expr in dimensions:
+            cursor.execute(f'''
+                INSERT INTO stock_daily_rollups (scope, region, medicine_name, snapshot_date, total_quantity,
+                                                 pharmacy_count, batch_count, expiring_quantity)
+                SELECT ?, {region_expr} AS region, {medicine_expr} AS medicine, ?,
+                       SUM(ps.quantity), COUNT(DISTINCT ps.pharmacy_id), COUNT(*),
+                       SUM(CASE WHEN ps.expiry_date <= date(?, ?) THEN ps.quantity ELSE 0 END)
+                FROM pharmacy_stocks ps
+                JOIN users u ON ps.pharmacy_id = u.id
+                WHERE u.is_approved = TRUE
+                GROUP BY region, medicine
+            ''', (scope, snapshot_date, snapshot_date, f"+{EXPIRY_WINDOW_DAYS} days"))
+        
+        conn.commit()
+
+async def rollup_loop():
+    while True:
+        try:
+            await asyncio.to_thread(build_daily_rollups)
+        except Exception as e:
+            print(f"Error building stock rollups: {e}")
+        await asyncio.sleep(ROLLUP_INTERVAL_SECONDS)
+
 def create_dummy_data():
     with get_db() as conn:
         cursor = conn.cursor()
@@ -313,6 +393,13 @@ async def startup_event():
             conn.commit()
     
     create_dummy_data()
+    app.state.rollup_task = asyncio.create_task(rollup_loop())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    rollup_task = getattr(app.state, "rollup_task", None)
+    if rollup_task:
+        rollup_task.cancel()
 
 @app.get("/")
 async def root():
@@ -653,6 +740,82 @@ async def get_government_dashboard(token_data: dict = Depends(verify_token)):
             "top_medicines": [dict(medicine) for medicine in top_medicines]
         }
 
+@app.get("/api/government/trends")
+async def get_stock_trends(
+    medicine_name: Optional[str] = None,
+    region: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    resolution: Optional[str] = None,
+    token_data: dict = Depends(verify_token)
+):
+    if token_data["user_type"] not in ["government", "admin"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    if not medicine_name and not region:
+        raise HTTPException(status_code=400, detail="Provide medicine_name, region or both")
+    
+    try:
+        end = datetime.date.fromisoformat(end_date) if end_date else datetime.date.today()
+        start = datetime.date.fromisoformat(start_date) if start_date else end - datetime.timedelta(days=89)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be in YYYY-MM-DD format")
+    
+    window_days = (end - start).days + 1
+    if window_days < 1:
+        raise HTTPException(status_code=400, detail="start_date must not be after end_date")
+    if window_days > MAX_TREND_WINDOW_DAYS:
+        raise HTTPException(status_code=400, detail=f"Date range cannot exceed {MAX_TREND_WINDOW_DAYS} days")
+    
+    # Long windows are downsampled so the response stays a few hundred points at most
+    if resolution is None:
+        resolution = "day" if window_days <= 90 else "week" if window_days <= 365 else "month"
+    if resolution not in TREND_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"resolution must be one of: {', '.join(TREND_BUCKETS)}")
+    
+    if medicine_name and region:
+        scope = "region_medicine"
+    elif medicine_name:
+        scope = "medicine"
+    else:
+        scope = "region"
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT {TREND_BUCKETS[resolution]} AS bucket_start,
+                   COUNT(*) AS samples,
+                   ROUND(AVG(total_quantity), 2) AS avg_total_quantity,
+                   MIN(total_quantity) AS min_total_quantity,
+                   MAX(total_quantity) AS max_total_quantity,
+                   ROUND(AVG(pharmacy_count), 2) AS avg_pharmacy_count,
+                   ROUND(AVG(batch_count), 2) AS avg_batch_count,
+                   ROUND(AVG(expiring_quantity), 2) AS avg_expiring_quantity
+            FROM stock_daily_rollups
+            WHERE scope = ? AND region = ? AND medicine_name = ?
+              AND snapshot_date BETWEEN ? AND ?
+            GROUP BY bucket_start
+            ORDER BY bucket_start
+        ''', (scope, region or "", medicine_name or "", start.isoformat(), end.isoformat()))
+        points = cursor.fetchall()
+        
+        return {
+            "medicine_name": medicine_name,
+            "region": region,
+            "start_date": start.isoformat(),
+            "end_date": end.isoformat(),
+            "resolution": resolution,
+            "points": [dict(point) for point in points]
+        }
+
+@app.post("/api/government/trends/refresh")
+async def refresh_stock_trends(token_data: dict = Depends(verify_token)):
+    if token_data["user_type"] not in ["government", "admin"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    await asyncio.to_thread(build_daily_rollups)
+    return {"message": "Stock rollups refreshed successfully"}
+
 if __name__ == "__main__":
     import uvicorn
     import os